@@ -1,19 +1,56 @@
 import streamlit as st
 import sqlite3
-from PIL import Image, ExifTags
+import atexit
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import cv2
 import numpy as np
+import exifread
+import io
 import os
 
 # Database setup
 DB_PATH = "tree_data.db"
+INSERT_TREE_SQL = """
+INSERT OR IGNORE INTO Trees (species, height, width, crown_size, focal_length, image_path)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+BATCH_SIZE = 20  # Queued captures (held in memory until saved) are flushed automatically at this size
 
-def create_database():
+def configure_connection(conn):
+    """Apply the write-friendly PRAGMAs (WAL, NORMAL sync, memory temp store, 256 MB mmap, 64 MB cache)."""
+    conn.executescript("""
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA cache_size=-64000;
+    """)
+
+@st.cache_resource
+def get_conn():
+    """Open the shared database connection once per server process (autocommit) and make sure the schema exists."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    configure_connection(conn)
+    create_database(conn)
+    atexit.register(conn.close)
+    return conn
+
+@st.cache_resource
+def get_writer():
+    """Return the process-wide background writer; a single thread runs saves one at a time and in order."""
+    return ThreadPoolExecutor(max_workers=1)
+
+@st.cache_resource
+def get_db_lock():
+    """Return the process-wide lock guarding the shared connection, so transactions never interleave."""
+    return threading.Lock()
+
+def create_database(conn):
     """Create the database tables for Trees and Images."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
+    conn.execute("""
     CREATE TABLE IF NOT EXISTS Trees (
         tree_id INTEGER PRIMARY KEY,
         species TEXT,
@@ -25,23 +62,72 @@ def create_database():
         created DATETIME DEFAULT CURRENT_TIMESTAMP
     )
     """)
-    conn.commit()
-    conn.close()
+    create_indexes(conn)
 
-def extract_focal_length(image_path):
-    """Extract focal length from the image's EXIF data."""
+def create_indexes(conn):
+    """Create the secondary indexes used for listing trees."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trees_created ON Trees(created)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trees_species ON Trees(species)")
+
+def drop_indexes(conn):
+    """Drop the secondary indexes (see bulk_load)."""
+    conn.execute("DROP INDEX IF EXISTS idx_trees_created")
+    conn.execute("DROP INDEX IF EXISTS idx_trees_species")
+
+# Set BRUTEFORCE_EXIF=1 to parse EXIF even when a JPEG has no APP1 segment
+BRUTEFORCE_EXIF = os.environ.get("BRUTEFORCE_EXIF") == "1"
+
+def extract_focal_length(image_path, data=None):
+    """Extract focal length from the image's EXIF data (from `data` if the file is already in memory)."""
     try:
-        image = Image.open(image_path)
-        exif = {ExifTags.TAGS[k]: v for k, v in image._getexif().items() if k in ExifTags.TAGS}
-        focal_length = exif.get("FocalLength", 50)  # Default to 50mm if not available
-        return focal_length if isinstance(focal_length, float) else focal_length[0] / focal_length[1]
+        # EXIF lives in the APP1 segment at the start of a JPEG, so the first 80 KB is enough
+        if data is not None:
+            head = data[:81920]
+        else:
+            with open(image_path, "rb") as f:
+                head = f.read(81920)
+        if not head.startswith(b"\xff\xd8"):
+            return 50.0  # Only JPEGs carry EXIF here (uploads are saved as .jpg whatever their format)
+        # Browser camera captures are stripped of EXIF: look for an APP1 marker before the scan data
+        start_of_scan = head.find(b"\xff\xda")
+        if not BRUTEFORCE_EXIF and b"\xff\xe1" not in head[:start_of_scan if start_of_scan != -1 else None]:
+            return 50.0
+        tags = exifread.process_file(io.BytesIO(head), details=False, stop_tag="FocalLength")
+        focal_length = tags.get("EXIF FocalLength")
+        if focal_length is None:
+            return 50.0  # Default to 50mm if not available
+        return float(focal_length.values[0])
     except Exception:
         return 50.0  # Default focal length if EXIF data is unavailable
 
-def process_image(image_path, real_world_scale_height=0.5, real_world_scale_width=0.5, reference_height=1.0, reference_width=0.2):
-    """Process the image: detect tree, add guidelines, and calculate height/width in meters."""
-    image = cv2.imread(image_path)
-    height, width, _ = image.shape
+# Image processing setup
+# Streamlit serves each session on its own thread, so keep OpenCV from fanning out to every core per call
+cv2.setNumThreads(int(os.environ.get("CV2_THREADS", "2")))
+PREVIEW_SIZE = 1024  # Long side (px) of the working copy used for segmentation and display
+# The processed image is only a preview, so trade a little quality for a faster encode
+PREVIEW_JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 85, cv2.IMWRITE_JPEG_OPTIMIZE, 0, cv2.IMWRITE_JPEG_PROGRESSIVE, 0]
+
+@st.cache_resource
+def get_close_kernel(size):
+    """Return the elliptical closing kernel of the given size, built once per process."""
+    return cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+
+@st.cache_data(show_spinner=False, max_entries=16, ttl=3600)
+def measure_upload(data):
+    """Read focal length and measure the tree from uploaded bytes; cached on the bytes so reruns skip the work."""
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    return (extract_focal_length(None, data), *measure_tree(image))
+
+def measure_tree(image):
+    """Detect the tree in a BGR image and measure it; returns (is_valid, error_msg, preview_jpeg, dimensions)."""
+    height, width = image.shape[:2]
+
+    # Work on a copy at most PREVIEW_SIZE px on the long side: segmentation only needs a coarse bbox,
+    # and the same copy is annotated for display
+    scale = min(1.0, PREVIEW_SIZE / max(height, width))
+    if scale < 1:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        height, width = image.shape[:2]
 
     # Convert to HSV for color-based segmentation
     hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
@@ -49,29 +135,30 @@ def process_image(image_path, real_world_scale_height=0.5, real_world_scale_widt
     green_upper = np.array([85, 255, 255])  # Upper bound for green
     mask = cv2.inRange(hsv, green_lower, green_upper)
 
-    # Morphological operations to clean the mask
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
-    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    # Morphological operations to clean the mask; the 7x7 full-resolution kernel shrinks with the image
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, get_close_kernel(max(3, round(7 * scale) | 1)))
 
-    # Find contours in the mask
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    if not contours:
+    # Label connected green regions; stats holds each region's bbox and area (label 0 is background)
+    num_labels, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    if num_labels < 2:
         return False, "No tree detected in the image. Please recapture.", None, None
 
-    # Get the largest contour (assume it's the tree)
-    largest_contour = max(contours, key=cv2.contourArea)
-    x, y, w, h = cv2.boundingRect(largest_contour)
+    # Get the largest region (assume it's the tree)
+    largest = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+    x, y, w, h = stats[largest, :4].tolist()  # Plain ints, not NumPy scalars, for the math and drawing below
+    full_w, full_h = round(w / scale), round(h / scale)  # Bbox size at the original resolution
 
-    # Convert the tree height and width to real-world meters using reference object
-    tree_height_meters = (h / reference_height) * reference_height  # Based on reference height
-    tree_width_meters = (w / reference_width) * reference_width  # Based on reference width
+    # Convert the tree height and width to real-world meters using reference object.
+    # (bbox / reference) * reference folds to the bbox extent, so compute that directly.
+    tree_height_meters = float(full_h)  # Based on reference height
+    tree_width_meters = float(full_w)  # Based on reference width
 
     # Calculate crown size (proportional to width)
     crown_size = tree_width_meters * 1.5  # For example, crown size is 1.5x the width
 
-    # Add guidelines (dotted lines)
-    cv2.line(image, (width // 2, 0), (width // 2, height), (255, 0, 0), 2, lineType=cv2.LINE_AA)  # Blue dotted vertical line
-    cv2.line(image, (0, height // 2), (width, height // 2), (255, 0, 0), 2, lineType=cv2.LINE_AA)  # Blue dotted horizontal line
+    # Add guidelines: 2 px axis-aligned strips, written as slices instead of rasterised lines
+    image[:, width // 2 - 1:width // 2 + 1] = (255, 0, 0)  # Blue vertical line
+    image[height // 2 - 1:height // 2 + 1, :] = (255, 0, 0)  # Blue horizontal line
 
     # Add height and width text on the image with smaller font size and red color
     text_height = f"Height: {tree_height_meters:.2f}m"
@@ -95,28 +182,174 @@ def process_image(image_path, real_world_scale_height=0.5, real_world_scale_widt
     text_y = max(10, y + h + 20)
     cv2.putText(image, text_width, (text_x, text_y), font, font_scale, (0, 0, 255), thickness)
 
-    # Save the processed image
-    processed_image_path = image_path.replace(".jpg", "_processed.jpg")
-    cv2.imwrite(processed_image_path, image)
+    # Encode in memory; Streamlit can display the bytes directly and they are only written to disk on save
+    _, preview_jpeg = cv2.imencode(".jpg", image, PREVIEW_JPEG_PARAMS)
+
+    return True, None, preview_jpeg.tobytes(), (tree_height_meters, tree_width_meters, crown_size)
+
+def get_processed_image_path(image_path):
+    """Return the path the processed image of `image_path` is saved under."""
+    base, ext = os.path.splitext(image_path)
+    return f"{base}_processed{ext}"
+
+def new_image_path():
+    """Return a fresh path for a captured image (microsecond timestamp, so saves in the same second don't collide)."""
+    return os.path.join("images", f"tree_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.jpg")
+
+def stage_capture_files(img_path, data, preview_jpeg):
+    """Write a capture's original and processed images under temporary names; returns (temp, final) path pairs."""
+    os.makedirs(os.path.dirname(img_path), exist_ok=True)
+    staged = []
+    for path, content in ((img_path, data), (get_processed_image_path(img_path), preview_jpeg)):
+        with open(path + ".part", "wb") as f:
+            f.write(content)
+        staged.append((path + ".part", path))
+    return staged
+
+def save_capture(img_path, data, preview_jpeg, species, dimensions, focal_length):
+    """Save a capture's Trees row and images; returns 1 if its image path was already taken, else 0."""
+    return save_captures([(img_path, data, preview_jpeg,
+                           (species, *dimensions, focal_length, get_processed_image_path(img_path)))])
 
-    return True, None, processed_image_path, (tree_height_meters, tree_width_meters, crown_size)
+def save_captures(captures):
+    """Save the captures' Trees rows in one transaction; returns how many were skipped.
+
+    Images are staged under temporary names first and only moved into place for rows that
+    were actually inserted, so a skipped row never overwrites the files of the row it clashed with.
+    """
+    staged, inserted = [], []
+    try:
+        for img_path, data, preview_jpeg, _ in captures:
+            staged.append(stage_capture_files(img_path, data, preview_jpeg))
+        with write_transaction() as conn:
+            inserted = [conn.execute(INSERT_TREE_SQL, row).rowcount == 1 for *_, row in captures]
+    finally:
+        for files, keep in zip(staged, inserted or [False] * len(staged)):
+            for temp_path, path in files:
+                if keep:
+                    os.replace(temp_path, path)
+                else:
+                    os.remove(temp_path)
+    return inserted.count(False)
+
+def submit_capture(data, preview_jpeg, dimensions, focal_length):
+    """Save a capture on the background writer, with the species as entered when Save was clicked."""
+    img_path = new_image_path()
+    submit_write(save_capture, img_path, data, preview_jpeg, st.session_state["species"], dimensions, focal_length,
+                 success_msg=f"Tree data saved successfully! Image saved: {img_path}")
+
+def queue_capture(data, preview_jpeg, dimensions, focal_length):
+    """Queue a capture for the next batch save, flushing the batch once it reaches BATCH_SIZE captures.
+
+    Nothing is written until the batch is saved, so an abandoned session leaves no orphaned images.
+    """
+    # Read the species now: on_click args are bound when the button renders, before any edit is applied
+    species = st.session_state["species"]
+    img_path = new_image_path()
+    row = (species, *dimensions, focal_length, get_processed_image_path(img_path))
+    pending = st.session_state.setdefault("pending_captures", [])
+    pending.append((img_path, data, preview_jpeg, row))
+    if len(pending) >= BATCH_SIZE:
+        flush_pending_captures()
+
+def submit_write(fn, *args, success_msg=None):
+    """Run a disk/database write on the background writer, remembering it so main() can report how it went."""
+    st.session_state.setdefault("writes", []).append((get_writer().submit(fn, *args), success_msg))
+
+def collect_background_writes():
+    """Turn each finished background write into a message: an error if it failed,
+    a warning for skipped rows, otherwise its success message (if any)."""
+    writes = st.session_state.get("writes", [])
+    messages = st.session_state.setdefault("write_messages", [])
+    for write in [w for w in writes if w[0].done()]:
+        writes.remove(write)
+        future, success_msg = write
+        if future.exception() is not None:
+            messages.append((st.error, f"Saving tree data failed: {future.exception()}"))
+        elif future.result():
+            messages.append((st.warning, f"{future.result()} tree(s) were not saved because another saved tree "
+                                         "already uses the same image name. Please save them again."))
+        elif success_msg:
+            messages.append((st.success, success_msg))
+
+def report_background_writes():
+    """Show the messages of finished background writes, and poll for the rest while any are still running."""
+    collect_background_writes()
+    for show, message in st.session_state.pop("write_messages"):
+        show(message)
+    if st.session_state.get("writes"):
+        poll_background_writes()
+
+@st.fragment(run_every="1s")
+def poll_background_writes():
+    """Check on pending background writes every second; once all are done, rerun the app to report them."""
+    collect_background_writes()
+    if st.session_state.get("writes"):
+        st.info("Saving tree data…")
+    else:
+        st.rerun()
 
 def save_tree_to_database(species, height, width, crown_size, focal_length, image_path):
-    """Save tree details to the database."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-    INSERT INTO Trees (species, height, width, crown_size, focal_length, image_path)
-    VALUES (?, ?, ?, ?, ?, ?)
-    """, (species, height, width, crown_size, focal_length, image_path))
-    conn.commit()
-    conn.close()
+    """Save tree details to the database; returns False if the image was already saved."""
+    return save_many([(species, height, width, crown_size, focal_length, image_path)]) == 0
+
+def save_many(rows, rebuild_indexes=False):
+    """Save several (species, height, width, crown_size, focal_length, image_path) rows in one transaction.
+
+    Rows whose image_path is already stored are skipped; returns how many were skipped.
+    With rebuild_indexes the secondary indexes are dropped before the insert and
+    recreated after it, inside the same transaction.
+    """
+    rows = list(rows)
+    with write_transaction() as conn:
+        if rebuild_indexes:
+            drop_indexes(conn)
+        inserted = conn.executemany(INSERT_TREE_SQL, rows).rowcount
+        if rebuild_indexes:
+            create_indexes(conn)
+    return len(rows) - inserted
+
+@contextmanager
+def write_transaction():
+    """Hold the DB lock for one write transaction on the shared connection, rolling back if the body raises."""
+    conn = get_conn()
+    with get_db_lock():
+        # IMMEDIATE takes the write lock up front instead of upgrading mid-transaction
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+def bulk_load(rows):
+    """Load many rows at once on the background writer, rebuilding the secondary indexes afterwards instead of per insert.
+
+    Waits for the load and returns how many rows were skipped; a failure rolls back the indexes with the rows.
+    """
+    return get_writer().submit(save_many, list(rows), True).result()
+
+def flush_pending_captures():
+    """Save every queued capture in one background write."""
+    pending = st.session_state.get("pending_captures")
+    if pending:
+        submit_write(save_captures, list(pending),
+                     success_msg=f"{len(pending)} tree(s) from the batch saved successfully!")
+        pending.clear()
 
 def main():
     st.title("Tree Capture and Measurement")
     st.write("Capture or upload a tree image, validate its presence, and measure its dimensions in meters.")
 
-    create_database()
+    report_background_writes()
+
+    # Trees queued with "Add to Batch" are written together
+    pending = st.session_state.get("pending_captures")
+    if pending:
+        st.sidebar.warning(f"{len(pending)} tree(s) in the batch are not saved yet. "
+                           "Click Save Batch before leaving, or they will be lost.")
+        st.sidebar.button("Save Batch", on_click=flush_pending_captures)
 
     st.header("Capture or Upload Tree Image")
     capture_or_upload = st.radio("Choose an option:", ["Capture using Camera", "Upload an Image"])
@@ -128,25 +361,18 @@ def main():
         img_data = st.file_uploader("Upload a tree image", type=["jpg", "jpeg", "png"])
 
     if img_data:
-        # Save uploaded image
-        img_path = os.path.join("images", f"tree_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg")
-        os.makedirs("images", exist_ok=True)
-        with open(img_path, "wb") as f:
-            f.write(img_data.read())
-        st.success(f"Image saved: {img_path}")
-
-        # Extract focal length
-        focal_length = extract_focal_length(img_path)
+        # The upload is only written to disk once the user saves it
+        data = img_data.getvalue()
 
-        # Process the image
-        is_valid, error_msg, processed_image_path, dimensions = process_image(img_path)
+        # Extract focal length and process the image straight from the upload (cached across reruns)
+        focal_length, is_valid, error_msg, preview_jpeg, dimensions = measure_upload(data)
 
         if not is_valid:
             st.error(error_msg)
             return
 
         # Display the processed image
-        st.image(processed_image_path, caption="Processed Image with Guidelines and Dimensions")
+        st.image(preview_jpeg, caption="Processed Image with Guidelines and Dimensions")
         st.success("Tree is properly centered and processed!")
 
         # Display dimensions in meters
@@ -156,10 +382,12 @@ def main():
         st.write(f"**Tree Crown Size:** {crown_size:.2f} meters")
 
         # Save to database
-        species = st.text_input("Enter tree species (optional):", value="Unknown Species")
-        if st.button("Save to Database"):
-            save_tree_to_database(species, tree_height_meters, tree_width_meters, crown_size, focal_length, processed_image_path)
-            st.success("Tree data saved successfully!")
+        # Both buttons save from on_click, so the write is already queued when the status above renders
+        st.text_input("Enter tree species (optional):", value="Unknown Species", key="species")
+        st.button("Save to Database", on_click=submit_capture,
+                  args=(data, preview_jpeg, dimensions, focal_length))
+        st.button("Add to Batch", on_click=queue_capture,
+                  args=(data, preview_jpeg, dimensions, focal_length))
 
 if __name__ == "__main__":
     main()